@@ -1,18 +1,23 @@
 from flask import Flask, request
+from werkzeug.exceptions import HTTPException
 from telegram import (
     Bot, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 )
 from telegram.ext import (
     Dispatcher, CommandHandler, MessageHandler, Filters, ConversationHandler, CallbackQueryHandler
 )
+from telegram.utils.request import Request
 import datetime
-import pytz
+from zoneinfo import ZoneInfo
 import os
 import logging
-import traceback
 import tempfile
+import io
 import requests
+import orjson
 import calendar
+from decimal import Decimal, ROUND_HALF_UP
+import re
 import psycopg2
 from psycopg2 import pool
 from reportlab.lib.pagesizes import A4
@@ -21,27 +26,53 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
+from PIL import Image as PILImage
 from dotenv import load_dotenv
 from pathlib import Path
 import time
 import atexit
+import functools
+import itertools
+import threading
+import hmac
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # === 初始化设置 ===
 app = Flask(__name__)
+# Telegram 的更新最多几十 KB，拒绝超大请求体以免在解析前就消耗大量资源
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
 
 # 加载环境变量
 env_path = Path('.') / '.env'
 load_dotenv(dotenv_path=env_path)
 
 TOKEN = os.getenv("TOKEN")
-ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "1165249082").split(",")))
+DATABASE_URL = os.getenv("DATABASE_URL")
+PORT = int(os.getenv("PORT", "5000"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+ADMIN_IDS = frozenset(map(int, os.getenv("ADMIN_IDS", "1165249082").split(",")))
 DEFAULT_HOURLY_RATE = float(os.getenv("DEFAULT_HOURLY_RATE", "20.00"))
 DEFAULT_MONTHLY_SALARY = float(os.getenv("DEFAULT_MONTHLY_SALARY", "3500.00"))
 WORKING_DAYS_PER_MONTH = int(os.getenv("WORKING_DAYS_PER_MONTH", "22"))
 WORKING_HOURS_PER_DAY = int(os.getenv("WORKING_HOURS_PER_DAY", "8"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "4"))
+PHOTO_DOWNLOAD_WORKERS = int(os.getenv("PHOTO_DOWNLOAD_WORKERS", "8"))
+PHOTO_CACHE_DIR = os.getenv("PHOTO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tg_photos"))
+PHOTO_CACHE_MAX_FILES = int(os.getenv("PHOTO_CACHE_MAX_FILES", "2000"))
+PHOTO_MAX_SIZE = int(os.getenv("PHOTO_MAX_SIZE", "800"))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "70"))
+# psycopg2 连接池只保留 minconn 个归还的连接，其余的会被关闭，
+# 因此 minconn 需覆盖处理更新的线程以及 PDF、照片后台线程
+DB_POOL_MIN_CONN = int(os.getenv("DB_POOL_MIN_CONN", str(UPDATE_WORKERS + 2)))
+DB_POOL_MAX_CONN = int(os.getenv("DB_POOL_MAX_CONN", "20"))
+# 连接在池中空闲超过该秒数后，取出时先用 SELECT 1 检测是否已被服务器或网络断开
+DB_POOL_PING_AFTER = int(os.getenv("DB_POOL_PING_AFTER", "300"))
 
 # 设置时区
 os.environ['TZ'] = os.getenv('TZ', 'Asia/Kuala_Lumpur')
+LOCAL_TZ = ZoneInfo("Asia/Kuala_Lumpur")
 
 # === 日志设置 ===
 logging.basicConfig(
@@ -49,10 +80,83 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# 开发服务器会为每个请求写一条访问日志，只保留警告及以上级别
+logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
 # === Telegram Bot 设置 ===
-bot = Bot(token=TOKEN)
+# 默认连接池只有 1 个连接，多线程并发调用 API 时连接无法复用，每次都要重新握手。
+# 连接池大小按可能同时访问 Telegram 的线程数设置
+bot = Bot(
+    token=TOKEN,
+    request=Request(con_pool_size=UPDATE_WORKERS + PDF_WORKERS * PHOTO_DOWNLOAD_WORKERS)
+)
 dispatcher = None
+dispatcher_lock = threading.Lock()
+
+# webhook 收到更新后立即返回，实际处理交给后台线程
+# 同一聊天的更新总是分配到同一个单线程执行器，保证对话状态按顺序推进
+update_executors = [ThreadPoolExecutor(max_workers=1) for _ in range(UPDATE_WORKERS)]
+
+# PDF 报告任务在专用的后台线程中排队执行，不占用处理更新的线程
+pdf_executor = ThreadPoolExecutor(max_workers=1)
+
+# 报销提交后在后台预先下载收据照片
+photo_executor = ThreadPoolExecutor(max_workers=1)
+
+# 同一时间只允许一个线程清理照片缓存
+photo_cache_lock = threading.Lock()
+
+# === 发送限流 ===
+# Telegram 限制全局约 30 条消息/秒、同一聊天约 1 条/秒，超出会返回 429
+SEND_LIMIT_PER_SECOND = 30
+SEND_INTERVAL_PER_CHAT = 1.0
+send_times = deque()
+last_send_by_chat = {}
+send_lock = threading.Lock()
+
+def wait_for_send_slot(chat_id):
+    """批量发送前调用，必要时等待直到可以安全发送下一条消息"""
+    with send_lock:
+        now = time.monotonic()
+        
+        # 同一聊天的发送间隔
+        last = last_send_by_chat.get(chat_id)
+        if last is not None and now - last < SEND_INTERVAL_PER_CHAT:
+            time.sleep(SEND_INTERVAL_PER_CHAT - (now - last))
+            now = time.monotonic()
+        
+        # 全局滑动窗口
+        while send_times and now - send_times[0] >= 1:
+            send_times.popleft()
+        if len(send_times) >= SEND_LIMIT_PER_SECOND:
+            time.sleep(1 - (now - send_times[0]))
+            now = time.monotonic()
+            send_times.popleft()
+        
+        send_times.append(now)
+        last_send_by_chat[chat_id] = now
+
+# 用户重复发送同一命令时，短时间内相同的回复只发送一次。
+# 按 (聊天 ID, 用户 ID) 记录，群组中不同司机的相同回复互不影响
+REPLY_DEDUP_SECONDS = 10.0
+REPLY_DEDUP_PRUNE_SIZE = 1024
+last_reply_by_sender = {}
+reply_lock = threading.Lock()
+
+def reply_once(update, text):
+    """同一用户的上一条回复相同且间隔很短时跳过发送，减少无意义的 API 调用"""
+    key = (update.effective_chat.id, update.effective_user.id)
+    now = time.monotonic()
+    with reply_lock:
+        last = last_reply_by_sender.get(key)
+        if last is not None and last[0] == text and now - last[1] < REPLY_DEDUP_SECONDS:
+            return
+        last_reply_by_sender[key] = (text, now)
+        # 过期的记录已不再起作用，条目较多时清理掉
+        if len(last_reply_by_sender) > REPLY_DEDUP_PRUNE_SIZE:
+            for old_key in [k for k, (_, sent) in last_reply_by_sender.items() if now - sent >= REPLY_DEDUP_SECONDS]:
+                del last_reply_by_sender[old_key]
+    update.message.reply_text(text)
 
 # === 状态常量 ===
 SALARY_SELECT_DRIVER = 0
@@ -69,16 +173,18 @@ PAID_END_DATE = 2    # 新增结束日期状态
 
 # === 数据库连接池 ===
 db_pool = None
+# 连接归还到池中的时间，按 id(conn) 记录
+db_conn_released_at = {}
 
 def init_db():
     """初始化数据库和表结构"""
     global db_pool
     try:
-        # 创建数据库连接池，设置合理的连接数
-        db_pool = psycopg2.pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=20,  # 增加最大连接数
-            dsn=os.environ.get("DATABASE_URL")
+        # 更新、PDF 和照片下载都在多个线程中访问数据库，需使用线程安全的连接池
+        db_pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn=DB_POOL_MIN_CONN,
+            maxconn=DB_POOL_MAX_CONN,
+            dsn=DATABASE_URL
         )
         logger.info("Database connection pool created successfully")
         
@@ -91,7 +197,7 @@ def init_db():
                     user_id BIGINT PRIMARY KEY,
                     username TEXT,
                     first_name TEXT,
-                    balance FLOAT DEFAULT 0.0,
+                    balance NUMERIC(12, 2) DEFAULT 0,
                     monthly_salary FLOAT DEFAULT 3500.0,
                     total_hours FLOAT DEFAULT 0.0,
                     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
@@ -117,7 +223,7 @@ def init_db():
                 CREATE TABLE IF NOT EXISTS topups (
                     id SERIAL PRIMARY KEY,
                     user_id BIGINT REFERENCES drivers(user_id),
-                    amount FLOAT NOT NULL,
+                    amount NUMERIC(12, 2) NOT NULL,
                     date DATE NOT NULL,
                     admin_id BIGINT,
                     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
@@ -130,25 +236,40 @@ def init_db():
                     id SERIAL PRIMARY KEY,
                     user_id BIGINT REFERENCES drivers(user_id),
                     type TEXT NOT NULL,
-                    amount FLOAT NOT NULL,
+                    amount NUMERIC(12, 2) NOT NULL,
                     date DATE NOT NULL,
                     photo_file_id TEXT,
                     status TEXT DEFAULT 'pending',
                     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                 )
                 """)
+                
+                # 旧版本用 FLOAT 存储金额，迁移为精确到分的 NUMERIC
+                migrate_money_columns(cur)
                 conn.commit()
                 logger.info("Database tables created successfully")
         finally:
             release_db_connection(conn)
             
     except Exception as e:
-        logger.error(f"Database initialization failed: {e}")
+        logger.error("Database initialization failed: %s", e)
         raise
 
+def migrate_money_columns(cur):
+    """将仍为 FLOAT 的金额字段转换为 NUMERIC(12, 2)"""
+    cur.execute("""
+    SELECT table_name, column_name
+    FROM information_schema.columns
+    WHERE (table_name, column_name) IN (('drivers', 'balance'), ('topups', 'amount'), ('claims', 'amount'))
+    AND data_type = 'double precision'
+    """)
+    for table, column in cur.fetchall():
+        cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE NUMERIC(12, 2)")
+        logger.info("Migrated %s.%s to NUMERIC(12, 2)", table, column)
+
 # === 数据库工具函数 ===
-def get_db_connection():
-    """获取数据库连接"""
+def checkout_db_connection():
+    """从连接池取出连接，连接池耗尽时等待后重试一次"""
     try:
         conn = db_pool.getconn()
         return conn
@@ -160,16 +281,39 @@ def get_db_connection():
             conn = db_pool.getconn()
             return conn
         except Exception as e:
-            logger.error(f"Failed to get database connection: {e}")
+            logger.error("Failed to get database connection: %s", e)
             raise
 
+def get_db_connection():
+    """获取数据库连接，空闲过久的连接先检测是否仍然可用"""
+    while True:
+        conn = checkout_db_connection()
+        released_at = db_conn_released_at.pop(id(conn), None)
+        if released_at is None or time.monotonic() - released_at < DB_POOL_PING_AFTER:
+            return conn
+        
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return conn
+        except psycopg2.Error as e:
+            # 连接已断开，关闭后重新获取；新建的连接不会再被检测
+            logger.warning("Discarding dead database connection: %s", e)
+            db_pool.putconn(conn, close=True)
+
 def release_db_connection(conn):
     """释放数据库连接回连接池"""
     try:
         if conn:
+            # 先记录再归还，避免其他线程取出连接时还没有记录
+            db_conn_released_at[id(conn)] = time.monotonic()
             db_pool.putconn(conn)
+            # 连接池已满时归还的连接会被直接关闭，无需保留记录
+            if conn.closed:
+                db_conn_released_at.pop(id(conn), None)
     except Exception as e:
-        logger.error(f"Error releasing database connection: {e}")
+        logger.error("Error releasing database connection: %s", e)
 
 def close_all_db_connections():
     """关闭所有数据库连接"""
@@ -178,11 +322,57 @@ def close_all_db_connections():
             db_pool.closeall()
             logger.info("All database connections closed")
     except Exception as e:
-        logger.error(f"Error closing database connections: {e}")
+        logger.error("Error closing database connections: %s", e)
 
 # 确保在应用退出时关闭所有数据库连接
 atexit.register(close_all_db_connections)
 
+# === 用户锁 ===
+# 按用户 ID 分段的锁：同一用户的写操作串行执行，不同用户之间几乎没有竞争
+user_locks = [threading.Lock() for _ in range(256)]
+
+def get_user_lock(user_id):
+    """获取用户对应的锁"""
+    return user_locks[user_id % len(user_locks)]
+
+# === 报表缓存 ===
+# /balance、/check 的回复和各司机选择键盘只在数据变更后才需要重新生成。
+# 每次写入后清空缓存并递增版本号；缓存项记录生成时的版本号，
+# 这样查询期间发生的写入也会让刚生成的结果失效。
+report_cache = {}
+report_cache_version = 0
+
+def invalidate_report_cache():
+    """数据变更后使报表缓存失效"""
+    global report_cache_version
+    report_cache_version += 1
+    report_cache.clear()
+
+def get_cached_report(key):
+    """获取仍然有效的缓存报表，没有则返回 None"""
+    entry = report_cache.get(key)
+    if entry and entry[0] == report_cache_version:
+        return entry[1]
+    return None
+
+# 本进程中已写入 drivers 表的用户及其名称 (username, first_name)。
+# 名称未变化时打卡等操作无需再写 drivers 表；用户改名后下一次操作会同步新名称
+known_drivers = {}
+
+def ensure_driver(cur, user):
+    """写入或同步 drivers 表中的用户名称，调用方提交事务后应调用 remember_driver"""
+    if known_drivers.get(user.id) == (user.username, user.first_name):
+        return
+    cur.execute(
+        "INSERT INTO drivers (user_id, username, first_name) VALUES (%s, %s, %s) "
+        "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, first_name = EXCLUDED.first_name",
+        (user.id, user.username, user.first_name)
+    )
+
+def remember_driver(user):
+    """记录已写入 drivers 表的用户名称"""
+    known_drivers[user.id] = (user.username, user.first_name)
+
 def get_driver(user_id):
     """获取司机信息"""
     conn = get_db_connection()
@@ -198,14 +388,12 @@ def update_driver(user_id, username=None, first_name=None, balance=None, monthly
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            # 检查司机是否存在
-            cur.execute("SELECT 1 FROM drivers WHERE user_id = %s", (user_id,))
-            if not cur.fetchone():
-                # 插入新司机
-                cur.execute(
-                    "INSERT INTO drivers (user_id, username, first_name) VALUES (%s, %s, %s)",
-                    (user_id, username, first_name)
-                )
+            # 司机不存在时插入
+            cur.execute(
+                "INSERT INTO drivers (user_id, username, first_name) VALUES (%s, %s, %s) "
+                "ON CONFLICT (user_id) DO NOTHING",
+                (user_id, username, first_name)
+            )
             
             updates = []
             params = []
@@ -232,34 +420,47 @@ def update_driver(user_id, username=None, first_name=None, balance=None, monthly
                 cur.execute(query, params)
             
             conn.commit()
+            invalidate_report_cache()
+            # 只更新了部分字段时名称未知，下一次 ensure_driver 会重新同步
+            known_drivers.pop(user_id, None)
     finally:
         release_db_connection(conn)
 
-def format_local_time(timestamp_str):
+def format_local_time(timestamp):
+    """将数据库返回的带时区时间格式化为本地时间"""
     try:
-        dt = datetime.datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-        return dt.strftime("%Y-%m-%d %H:%M")
-    except:
-        return timestamp_str
+        return timestamp.astimezone(LOCAL_TZ).strftime("%Y-%m-%d %H:%M")
+    except (AttributeError, ValueError):
+        return str(timestamp)
+
+def display_name(username, first_name):
+    """司机显示名称：有用户名时显示 @用户名，否则显示名字"""
+    return f"@{username}" if username else first_name
 
 def format_duration(hours):
+    """将小时数格式化为 xHour yMin 形式"""
     try:
         total_minutes = int(float(hours) * 60)
-        hours_part = total_minutes // 60
-        minutes_part = total_minutes % 60
-        
-        if hours_part > 0 and minutes_part > 0:
-            return f"{hours_part}Hour {minutes_part}Min"
-        elif hours_part > 0:
-            return f"{hours_part}Hour"
-        else:
-            return f"{minutes_part}Min"
     except:
         return str(hours)
+    return format_minutes(total_minutes)
+
+@functools.lru_cache(maxsize=2048)
+def format_minutes(total_minutes):
+    """按整分钟数格式化时长（带缓存，工时精确到微秒，换算成分钟后才会重复）"""
+    hours_part = total_minutes // 60
+    minutes_part = total_minutes % 60
+    
+    if hours_part > 0 and minutes_part > 0:
+        return f"{hours_part}Hour {minutes_part}Min"
+    elif hours_part > 0:
+        return f"{hours_part}Hour"
+    else:
+        return f"{minutes_part}Min"
 
 def get_month_date_range(date=None):
     if date is None:
-        date = datetime.datetime.now(pytz.timezone("Asia/Kuala_Lumpur"))
+        date = datetime.datetime.now(LOCAL_TZ)
     
     year = date.year
     month = date.month
@@ -267,27 +468,173 @@ def get_month_date_range(date=None):
     last_day = datetime.date(year, month, calendar.monthrange(year, month)[1])
     return first_day, last_day
 
+# 金额只接受非负的普通小数，允许 .5 和 5. 这类写法
+AMOUNT_PATTERN = re.compile(r'^(\d*\.\d+|\d+\.?\d*)$')
+CENT = Decimal('0.01')
+# 预先绑定金额格式化方法，报表循环中无需重复解析格式串
+format_rm = "RM{:.2f}".format
+
+def parse_amount(text):
+    """解析金额输入并精确到分，格式无效时返回 None"""
+    text = text.strip()
+    if not AMOUNT_PATTERN.match(text):
+        return None
+    return Decimal(text).quantize(CENT, rounding=ROUND_HALF_UP)
+
+@functools.lru_cache(maxsize=128)
 def calculate_hourly_rate(monthly_salary):
+    """按月薪计算时薪（带缓存，常见月薪只需计算一次）"""
     try:
         return round(float(monthly_salary) / (WORKING_DAYS_PER_MONTH * WORKING_HOURS_PER_DAY), 2)
     except:
         return DEFAULT_HOURLY_RATE
 
 # === PDF 生成功能 ===
+# 样式在所有报告间共享，只需创建一次
+PDF_STYLES = getSampleStyleSheet()
+
+CLOCK_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 12),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ('ALIGN', (0, 1), (-1, -1), 'CENTER'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+])
+
+CLAIM_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+])
+
+SUMMARY_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.lightgrey),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+])
+
+def save_compressed_photo(buf, path):
+    """将照片缩小到 PDF 所需的尺寸后以 JPEG 保存，无法识别的文件按原样保存"""
+    buf.seek(0)
+    try:
+        with PILImage.open(buf) as img:
+            img.thumbnail((PHOTO_MAX_SIZE, PHOTO_MAX_SIZE))
+            img.convert('RGB').save(path, 'JPEG', quality=PHOTO_JPEG_QUALITY, optimize=True)
+    except OSError:
+        with open(path, 'wb') as f:
+            f.write(buf.getvalue())
+
 def download_telegram_photo(file_id, bot):
+    """下载 Telegram 照片，按 file_id 缓存在磁盘上"""
+    path = os.path.join(PHOTO_CACHE_DIR, f"{file_id}.jpg")
     try:
+        # 更新访问时间，供清理时按最近使用排序；文件已被清理时按未缓存处理
+        os.utime(path)
+        return path
+    except OSError:
+        pass
+    
+    # 先写入临时文件再重命名，避免并发下载时读到不完整的照片
+    partial_path = f"{path}.{threading.get_ident()}.part"
+    try:
+        os.makedirs(PHOTO_CACHE_DIR, exist_ok=True)
         file = bot.get_file(file_id)
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.jpg')
-        file.download(temp_file.name)
-        return temp_file.name
+        buf = io.BytesIO()
+        file.download(out=buf)
+        save_compressed_photo(buf, partial_path)
+        os.replace(partial_path, path)
+        return path
     except Exception as e:
-        logger.error(f"Error downloading photo: {str(e)}")
+        logger.error("Error downloading photo: %s", e)
+        # 清理未完成的临时文件，prune_photo_cache 只会清理 .jpg 文件
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
         return None
 
-def generate_driver_pdf(driver_id, driver_name, bot, output_path):
-    """生成司机PDF报告"""
+def photo_mtime(entry):
+    """读取缓存照片的修改时间，文件已被删除时返回 None"""
+    try:
+        return entry.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+def prune_photo_cache():
+    """照片缓存超过上限时删除最久未使用的文件"""
+    with photo_cache_lock:
+        try:
+            entries = [entry for entry in os.scandir(PHOTO_CACHE_DIR) if entry.name.endswith('.jpg')]
+        except FileNotFoundError:
+            return
+        
+        # 已消失的文件视为已清理
+        entries = [(photo_mtime(entry), entry.path) for entry in entries]
+        entries = [item for item in entries if item[0] is not None]
+        if len(entries) <= PHOTO_CACHE_MAX_FILES:
+            return
+        
+        entries.sort()
+        for _, path in entries[:len(entries) - PHOTO_CACHE_MAX_FILES]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error("Error removing cached photo %s: %s", path, e)
+
+def fetch_driver_report_data(driver_ids):
+    """每张表一次查询读取多个司机的报告数据，
+    返回 {司机ID: (司机信息, 打卡记录, 报销记录)}"""
+    driver_ids = list(driver_ids)
+    drivers = dict.fromkeys(driver_ids)
+    records = {driver_id: ([], []) for driver_id in driver_ids}
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            # 基本信息
+            cur.execute("SELECT * FROM drivers WHERE user_id = ANY(%s)", (driver_ids,))
+            for row in cur.fetchall():
+                drivers[row[0]] = row
+            
+            # 打卡记录（工时直接在数据库中批量计算）和报销记录，均按司机和日期排序后分组
+            for index, sql in enumerate((
+                """
+                SELECT user_id, date, clock_in, clock_out, is_off,
+                       EXTRACT(EPOCH FROM (clock_out - clock_in)) / 3600.0 AS hours
+                FROM clock_logs
+                WHERE user_id = ANY(%s)
+                ORDER BY user_id, date DESC
+                """,
+                """
+                SELECT user_id, type, amount, date, photo_file_id
+                FROM claims
+                WHERE user_id = ANY(%s)
+                ORDER BY user_id, date DESC
+                """,
+            )):
+                cur.execute(sql, (driver_ids,))
+                for user_id, rows in itertools.groupby(cur.fetchall(), key=lambda row: row[0]):
+                    records[user_id][index].extend(row[1:] for row in rows)
+    finally:
+        release_db_connection(conn)
+    return {driver_id: (drivers[driver_id],) + records[driver_id] for driver_id in driver_ids}
+
+def generate_driver_pdf(driver_name, data, bot, output):
+    """根据 fetch_driver_report_data 读取的数据生成司机PDF报告，
+    output 可以是文件路径或可写的文件对象"""
     doc = SimpleDocTemplate(
-        output_path,
+        output,
         pagesize=A4,
         rightMargin=72,
         leftMargin=72,
@@ -295,42 +642,9 @@ def generate_driver_pdf(driver_id, driver_name, bot, output_path):
         bottomMargin=72
     )
     
-    styles = getSampleStyleSheet()
+    styles = PDF_STYLES
     elements = []
-    
-    # 获取司机数据
-    with db_pool.getconn() as conn:
-        with conn.cursor() as cur:
-            # 基本信息
-            cur.execute("SELECT * FROM drivers WHERE user_id = %s", (driver_id,))
-            driver = cur.fetchone()
-            
-            # 打卡记录
-            cur.execute("""
-            SELECT date, clock_in, clock_out, is_off 
-            FROM clock_logs 
-            WHERE user_id = %s 
-            ORDER BY date DESC
-            """, (driver_id,))
-            clock_logs = cur.fetchall()
-            
-            # 报销记录
-            cur.execute("""
-            SELECT type, amount, date, photo_file_id 
-            FROM claims 
-            WHERE user_id = %s 
-            ORDER BY date DESC
-            """, (driver_id,))
-            claims = cur.fetchall()
-            
-            # 充值记录
-            cur.execute("""
-            SELECT amount, date 
-            FROM topups 
-            WHERE user_id = %s 
-            ORDER BY date DESC
-            """, (driver_id,))
-            topups = cur.fetchall()
+    driver, clock_logs, claims = data
     
     # 标题
     title = Paragraph(f"Driver Report: {driver_name}", styles['Title'])
@@ -343,7 +657,7 @@ def generate_driver_pdf(driver_id, driver_name, bot, output_path):
     total_hours = driver[5] if driver else 0.0
     
     for log in clock_logs:
-        date, in_time, out_time, is_off = log
+        date, in_time, out_time, is_off, hours_float = log
         date_str = date.strftime("%Y-%m-%d")
         
         if is_off:
@@ -353,33 +667,12 @@ def generate_driver_pdf(driver_id, driver_name, bot, output_path):
         in_time_str = format_local_time(in_time) if in_time else "N/A"
         out_time_str = format_local_time(out_time) if out_time else "N/A"
         
-        hours = "N/A"
-        if in_time and out_time:
-            try:
-                in_dt = datetime.datetime.strptime(in_time, "%Y-%m-%d %H:%M:%S")
-                out_dt = datetime.datetime.strptime(out_time, "%Y-%m-%d %H:%M:%S")
-                duration = out_dt - in_dt
-                hours_float = duration.total_seconds() / 3600
-                hours = format_duration(hours_float)
-            except:
-                hours = "Error"
-                
+        hours = format_duration(hours_float) if hours_float is not None else "N/A"
         clock_data.append([date_str, in_time_str, out_time_str, hours])
     
     if len(clock_data) > 1:
         clock_table = Table(clock_data, colWidths=[80, 120, 120, 60])
-        clock_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 12),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('ALIGN', (0, 1), (-1, -1), 'CENTER'),
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ]))
+        clock_table.setStyle(CLOCK_TABLE_STYLE)
         elements.append(clock_table)
     else:
         elements.append(Paragraph("No clock records found.", styles['Normal']))
@@ -390,32 +683,38 @@ def generate_driver_pdf(driver_id, driver_name, bot, output_path):
     elements.append(Paragraph("Expense Claims", styles['Heading2']))
     
     if claims:
+        # 并行下载所有收据照片，避免逐张串行请求 Telegram
+        photo_ids = list({claim[3] for claim in claims if claim[3]})
+        photo_paths = {}
+        if photo_ids:
+            with ThreadPoolExecutor(max_workers=min(PHOTO_DOWNLOAD_WORKERS, len(photo_ids))) as executor:
+                photo_paths = dict(zip(
+                    photo_ids,
+                    executor.map(lambda file_id: download_telegram_photo(file_id, bot), photo_ids)
+                ))
+        
+        # 所有报销记录放在同一个表格中，收据照片占据其下方合并后的整行
+        claim_data = [['Date', 'Type', 'Amount']]
+        photo_rows = []
         for claim in claims:
             claim_type, amount, date, photo_id = claim
-            claim_data = [
-                [f"Date: {date}", f"Type: {claim_type}", f"Amount: RM{amount:.2f}"]
-            ]
-            
-            claim_table = Table(claim_data, colWidths=[120, 120, 120])
-            claim_table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.lightblue),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black),
-                ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ]))
-            elements.append(claim_table)
+            claim_data.append([str(date), claim_type, format_rm(amount)])
             
-            if photo_id:
+            photo_path = photo_paths.get(photo_id) if photo_id else None
+            if photo_path:
                 try:
-                    photo_path = download_telegram_photo(photo_id, bot)
-                    if photo_path:
-                        img = Image(photo_path, width=300, height=200)
-                        elements.append(img)
-                        elements.append(Spacer(1, 6))
+                    claim_data.append([Image(photo_path, width=300, height=200), '', ''])
                 except Exception as e:
-                    elements.append(Paragraph(f"Error loading photo: {str(e)}", styles['Normal']))
-            
-            elements.append(Spacer(1, 10))
+                    claim_data.append([Paragraph(f"Error loading photo: {str(e)}", styles['Normal']), '', ''])
+                photo_rows.append(len(claim_data) - 1)
+        
+        claim_table = Table(claim_data, colWidths=[120, 120, 120])
+        claim_table.setStyle(TableStyle(
+            [('SPAN', (0, row), (-1, row)) for row in photo_rows] +
+            [('ALIGN', (0, row), (-1, row), 'CENTER') for row in photo_rows],
+            parent=CLAIM_TABLE_STYLE
+        ))
+        elements.append(claim_table)
     else:
         elements.append(Paragraph("No claims found.", styles['Normal']))
     
@@ -431,7 +730,7 @@ def generate_driver_pdf(driver_id, driver_name, bot, output_path):
     ))
     
     hourly_rate = calculate_hourly_rate(driver[4]) if driver else DEFAULT_HOURLY_RATE
-    monthly_salary = f"RM{driver[4]:.2f}" if driver else "N/A"
+    monthly_salary = format_rm(driver[4]) if driver else "N/A"
     gross_pay = total_hours * hourly_rate
     
     elements.append(Paragraph(
@@ -448,25 +747,38 @@ def generate_driver_pdf(driver_id, driver_name, bot, output_path):
     
     summary_data = [
         ['Total Hours', 'Total Claims', 'Account Balance'],
-        [format_duration(total_hours), f"RM{total_claims:.2f}", f"RM{balance:.2f}"]
+        [format_duration(total_hours), format_rm(total_claims), format_rm(balance)]
     ]
     
     summary_table = Table(summary_data, colWidths=[120, 120, 120])
-    summary_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.darkblue),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.lightgrey),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-    ]))
+    summary_table.setStyle(SUMMARY_TABLE_STYLE)
     elements.append(summary_table)
     
     doc.build(elements)
-    return output_path
+    return output
 
 # === 命令处理函数 ===
+# /start 回复模板，只需在运行时填入用户名
+START_MSG_USER = (
+    "👋 Hello {name}!\n"
+    "Welcome to Driver ClockIn Bot.\n\n"
+    "Available Commands:\n"
+    "🕑 /clockin\n"
+    "🏁 /clockout\n"
+    "📅 /offday\n"
+    "💸 /claim"
+)
+START_MSG_ADMIN = START_MSG_USER + (
+    "\n\n🔐 Admin Commands:\n"
+    "📊 /balance\n"
+    "📄 /check\n"
+    "🧾 /PDF\n"
+    "💵 /topup\n"
+    "📷 /viewclaims\n"
+    "💰 /salary\n"
+    "🟢 /paid"
+)
+
 def start(update, context):
     user = update.effective_user
     update_driver(
@@ -475,180 +787,178 @@ def start(update, context):
         first_name=user.first_name
     )
     
-    msg = (
-        f"👋 Hello {user.first_name}!\n"
-        "Welcome to Driver ClockIn Bot.\n\n"
-        "Available Commands:\n"
-        "🕑 /clockin\n"
-        "🏁 /clockout\n"
-        "📅 /offday\n"
-        "💸 /claim"
-    )
-    if user.id in ADMIN_IDS:
-        msg += (
-            "\n\n🔐 Admin Commands:\n"
-            "📊 /balance\n"
-            "📄 /check\n"
-            "🧾 /PDF\n"
-            "💵 /topup\n"
-            "📷 /viewclaims\n"
-            "💰 /salary\n"
-            "🟢 /paid"
-        )
-
-    update.message.reply_text(msg)
+    msg = START_MSG_ADMIN if user.id in ADMIN_IDS else START_MSG_USER
+    update.message.reply_text(msg.format(name=user.first_name))
 
 def clockin(update, context):
     user = update.effective_user
     now = get_current_time()
     today = now.date()
-    clock_time = now.strftime("%Y-%m-%d %H:%M:%S")
+    clock_time = now.strftime("%Y-%m-%d %H:%M")
     
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            # 检查是否已有记录
-            cur.execute(
-                "SELECT 1 FROM clock_logs WHERE user_id = %s AND date = %s",
-                (user.id, today)
-            )
-            if cur.fetchone():
-                # 更新记录
-                cur.execute(
-                    "UPDATE clock_logs SET clock_in = %s, is_off = FALSE WHERE user_id = %s AND date = %s",
-                    (clock_time, user.id, today)
-                )
-            else:
-                # 插入新记录
+    # 同一用户的操作串行执行，避免并发请求交错读写
+    with get_user_lock(user.id):
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                # 管理员命令直接从 drivers 表读取名称，无需查询 Telegram
+                ensure_driver(cur, user)
+                
+                # 检查是否已有记录
                 cur.execute(
-                    "INSERT INTO clock_logs (user_id, date, clock_in) VALUES (%s, %s, %s)",
-                    (user.id, today, clock_time)
+                    "SELECT 1 FROM clock_logs WHERE user_id = %s AND date = %s",
+                    (user.id, today)
                 )
-            conn.commit()
-    finally:
-        release_db_connection(conn)
+                if cur.fetchone():
+                    # 更新记录
+                    cur.execute(
+                        "UPDATE clock_logs SET clock_in = %s, is_off = FALSE WHERE user_id = %s AND date = %s",
+                        (now, user.id, today)
+                    )
+                else:
+                    # 插入新记录
+                    cur.execute(
+                        "INSERT INTO clock_logs (user_id, date, clock_in) VALUES (%s, %s, %s)",
+                        (user.id, today, now)
+                    )
+                conn.commit()
+                invalidate_report_cache()
+                remember_driver(user)
+        finally:
+            release_db_connection(conn)
     
-    update.message.reply_text(f"✅ Clocked in at {format_local_time(clock_time)}")
+    reply_once(update, f"✅ Clocked in at {clock_time}")
 
 def clockout(update, context):
     user = update.effective_user
     now = get_current_time()
     today = now.date()
-    clock_time = now.strftime("%Y-%m-%d %H:%M:%S")
+    clock_time = now.strftime("%Y-%m-%d %H:%M")
     
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            # 检查是否已打卡
-            cur.execute(
-                "SELECT clock_in FROM clock_logs WHERE user_id = %s AND date = %s",
-                (user.id, today)
-            )
-            log = cur.fetchone()
-            
-            if not log or not log[0] or log[0] == "OFF":
-                update.message.reply_text("❌ You haven't clocked in today.")
-                return
-            
-            # 更新打卡时间 
-            cur.execute(
-                "UPDATE clock_logs SET clock_out = %s WHERE user_id = %s AND date = %s",
-                (clock_time, user.id, today)
-            )
-            
-            # 计算工时
-            in_time = datetime.datetime.strptime(log[0], "%Y-%m-%d %H:%M:%S")
-            out_time = datetime.datetime.strptime(clock_time, "%Y-%m-%d %H:%M:%S")
-            hours_worked = (out_time - in_time).total_seconds() / 3600
-            
-            # 更新总工时
-            cur.execute(
-                "UPDATE drivers SET total_hours = total_hours + %s WHERE user_id = %s",
-                (hours_worked, user.id)
-            )
-            conn.commit()
-    finally:
-        release_db_connection(conn)
+    # 同一用户的操作串行执行，避免并发请求交错读写
+    with get_user_lock(user.id):
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                # 更新打卡时间，并由数据库直接返回工时；只更新尚未下班打卡的记录，
+                # 重复下班打卡不会重复累计工时
+                cur.execute("""
+                    UPDATE clock_logs SET clock_out = %s
+                    WHERE user_id = %s AND date = %s AND clock_in IS NOT NULL AND NOT is_off
+                      AND clock_out IS NULL
+                    RETURNING EXTRACT(EPOCH FROM (clock_out - clock_in)) / 3600.0
+                """, (now, user.id, today))
+                log = cur.fetchone()
+                
+                if not log:
+                    # 没有返回行时区分已下班打卡和尚未打卡
+                    cur.execute("""
+                        SELECT clock_out FROM clock_logs
+                        WHERE user_id = %s AND date = %s AND clock_in IS NOT NULL AND NOT is_off
+                    """, (user.id, today))
+                    existing = cur.fetchone()
+                    if existing and existing[0]:
+                        reply_once(update, f"❌ You already clocked out at {format_local_time(existing[0])}.")
+                    else:
+                        reply_once(update, "❌ You haven't clocked in today.")
+                    return
+                
+                hours_worked = float(log[0])
+                
+                # 更新总工时
+                cur.execute(
+                    "UPDATE drivers SET total_hours = total_hours + %s WHERE user_id = %s",
+                    (hours_worked, user.id)
+                )
+                conn.commit()
+                invalidate_report_cache()
+        finally:
+            release_db_connection(conn)
     
     time_str = format_duration(hours_worked)
-    update.message.reply_text(
-        f"🏁 Clocked out at {format_local_time(clock_time)}. Worked {time_str}."
-    )
+    reply_once(update, f"🏁 Clocked out at {clock_time}. Worked {time_str}.")
 
 def offday(update, context):
     user = update.effective_user
     today = get_current_date()
     
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            # 标记休息日
-            cur.execute(
-                "INSERT INTO clock_logs (user_id, date, is_off) VALUES (%s, %s, TRUE) "
-                "ON CONFLICT (user_id, date) DO UPDATE SET is_off = TRUE, clock_in = NULL, clock_out = NULL",
-                (user.id, today)
-            )
-            conn.commit()
-    finally:
-        release_db_connection(conn)
+    # 同一用户的操作串行执行，避免并发请求交错读写
+    with get_user_lock(user.id):
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                ensure_driver(cur, user)
+                
+                # 标记休息日
+                cur.execute(
+                    "INSERT INTO clock_logs (user_id, date, is_off) VALUES (%s, %s, TRUE) "
+                    "ON CONFLICT (user_id, date) DO UPDATE SET is_off = TRUE, clock_in = NULL, clock_out = NULL",
+                    (user.id, today)
+                )
+                conn.commit()
+                invalidate_report_cache()
+                remember_driver(user)
+        finally:
+            release_db_connection(conn)
     
-    update.message.reply_text(f"📅 Marked {today} as off day.")
+    reply_once(update, f"📅 Marked {today} as off day.")
 
 def balance(update, context):
-    if update.effective_user.id not in ADMIN_IDS:
-        return
-    
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT user_id, first_name, username, balance FROM drivers")
-            drivers = cur.fetchall()
-    finally:
-        release_db_connection(conn)
-    
-    msg = "📊 Driver Balances:\n"
-    for driver in drivers:
-        name = f"@{driver[2]}" if driver[2] else driver[1]
-        msg += f"• {name}: RM{driver[3]:.2f}\n"
+    msg = get_cached_report('balance')
+    if msg is None:
+        version = report_cache_version
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT user_id, first_name, username, balance FROM drivers")
+                drivers = cur.fetchall()
+        finally:
+            release_db_connection(conn)
+        
+        lines = ["📊 Driver Balances:\n"]
+        for driver in drivers:
+            name = display_name(driver[2], driver[1])
+            lines.append(f"• {name}: {format_rm(driver[3])}\n")
+        msg = "".join(lines)
+        report_cache['balance'] = (version, msg)
     
     update.message.reply_text(msg)
 
 def check(update, context):
-    if update.effective_user.id not in ADMIN_IDS:
-        return
-    
     today = get_current_date()
     
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-            SELECT d.user_id, d.first_name, d.username, l.clock_in, l.clock_out, l.is_off
-            FROM drivers d
-            LEFT JOIN clock_logs l ON d.user_id = l.user_id AND l.date = %s
-            """, (today,))
-            logs = cur.fetchall()
-    finally:
-        release_db_connection(conn)
-    
-    msg = "📄 Today's Status:\n"
-    for log in logs:
-        user_id, first_name, username, in_time, out_time, is_off = log
-        name = f"@{username}" if username else first_name
+    msg = get_cached_report(('check', today))
+    if msg is None:
+        version = report_cache_version
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                SELECT d.user_id, d.first_name, d.username, l.clock_in, l.clock_out, l.is_off
+                FROM drivers d
+                LEFT JOIN clock_logs l ON d.user_id = l.user_id AND l.date = %s
+                """, (today,))
+                logs = cur.fetchall()
+        finally:
+            release_db_connection(conn)
         
-        if is_off:
-            msg += f"• {name}: OFF DAY\n"
-        else:
-            in_str = format_local_time(in_time) if in_time else "❌"
-            out_str = format_local_time(out_time) if out_time else "❌"
-            msg += f"• {name}: IN: {in_str}, OUT: {out_str}\n"
+        lines = ["📄 Today's Status:\n"]
+        for log in logs:
+            user_id, first_name, username, in_time, out_time, is_off = log
+            name = display_name(username, first_name)
+            
+            if is_off:
+                lines.append(f"• {name}: OFF DAY\n")
+            else:
+                in_str = format_local_time(in_time) if in_time else "❌"
+                out_str = format_local_time(out_time) if out_time else "❌"
+                lines.append(f"• {name}: IN: {in_str}, OUT: {out_str}\n")
+        msg = "".join(lines)
+        report_cache[('check', today)] = (version, msg)
     
     update.message.reply_text(msg)
 
 def viewclaims(update, context):
-    if update.effective_user.id not in ADMIN_IDS:
-        return
-    
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
@@ -663,42 +973,53 @@ def viewclaims(update, context):
     finally:
         release_db_connection(conn)
     
-    msg = "📷 Recent Claims:\n"
+    lines = ["📷 Recent Claims:\n"]
     for claim in claims:
         user_id, first_name, username, claim_type, amount, date = claim
-        name = f"@{username}" if username else first_name
-        msg += f"• {name}: RM{amount:.2f} ({claim_type}) on {date}\n"
+        name = display_name(username, first_name)
+        lines.append(f"• {name}: {format_rm(amount)} ({claim_type}) on {date}\n")
     
-    update.message.reply_text(msg)
+    update.message.reply_text("".join(lines))
+
+# === 司机选择键盘 ===
+def get_driver_select_keyboard():
+    """获取 /salary 和 /topup 共用的司机选择键盘及选项到司机 ID 的映射"""
+    # 与报表共用缓存，司机数据变更后自动重建
+    cached = get_cached_report('driver_keyboard')
+    if cached is not None:
+        return cached
+    
+    version = report_cache_version
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT user_id, first_name, username FROM drivers")
+            drivers = cur.fetchall()
+    finally:
+        release_db_connection(conn)
+    
+    options = {f"{driver[1]} (ID: {driver[0]})": driver[0] for driver in drivers}
+    keyboard = ReplyKeyboardMarkup([[option] for option in options], one_time_keyboard=True)
+    report_cache['driver_keyboard'] = (version, (keyboard, options))
+    return keyboard, options
 
 # === 薪资设置功能 ===
 def salary_start(update, context):
     """开始设置薪资"""
     try:
-        if update.effective_user.id not in ADMIN_IDS:
-            return
-        
         # 清理之前的状态
         context.user_data.clear()
         
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cur:
-                cur.execute("SELECT user_id, first_name, username FROM drivers")
-                drivers = cur.fetchall()
-        finally:
-            release_db_connection(conn)
-        
-        keyboard = [[f"{driver[1]} (ID: {driver[0]})"] for driver in drivers]
-        context.user_data['salary_drivers'] = {f"{driver[1]} (ID: {driver[0]})": driver[0] for driver in drivers}
+        keyboard, options = get_driver_select_keyboard()
+        context.user_data['salary_drivers'] = options
         
         update.message.reply_text(
             "👤 Select driver to set salary:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+            reply_markup=keyboard
         )
         return SALARY_SELECT_DRIVER
     except Exception as e:
-        logger.error(f"Error in salary_start: {str(e)}")
+        logger.error("Error in salary_start: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /salary command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -724,7 +1045,7 @@ def salary_select_driver(update, context):
         )
         return SALARY_ENTER_AMOUNT
     except Exception as e:
-        logger.error(f"Error in salary_select_driver: {str(e)}")
+        logger.error("Error in salary_select_driver: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /salary command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -733,9 +1054,8 @@ def salary_select_driver(update, context):
 
 def salary_enter_amount(update, context):
     try:
-        try:
-            amount = float(update.message.text)
-        except ValueError:
+        amount = parse_amount(update.message.text)
+        if amount is None:
             update.message.reply_text(
                 "❌ Please enter a valid number.",
                 reply_markup=ReplyKeyboardRemove()
@@ -766,7 +1086,7 @@ def salary_enter_amount(update, context):
         context.user_data.clear()
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Error in salary_enter_amount: {str(e)}")
+        logger.error("Error in salary_enter_amount: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /salary command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -774,14 +1094,20 @@ def salary_enter_amount(update, context):
         return ConversationHandler.END
 
 # === PDF 生成功能 ===
-def pdf_start(update, context):
-    if update.effective_user.id not in ADMIN_IDS:
-        return
+def get_pdf_select_keyboard():
+    """获取 /PDF 的司机选择内联键盘，与报表共用缓存"""
+    cached = get_cached_report('pdf_keyboard')
+    if cached is not None:
+        return cached
     
-    with db_pool.getconn() as conn:
+    version = report_cache_version
+    conn = get_db_connection()
+    try:
         with conn.cursor() as cur:
             cur.execute("SELECT user_id, first_name, username FROM drivers")
             drivers = cur.fetchall()
+    finally:
+        release_db_connection(conn)
     
     keyboard = [
         [InlineKeyboardButton("📊 All Drivers", callback_data="all")]
@@ -791,114 +1117,141 @@ def pdf_start(update, context):
     for driver in drivers:
         keyboard.append([
             InlineKeyboardButton(
-                f"@{driver[2]}" if driver[2] else driver[1],
+                display_name(driver[2], driver[1]),
                 callback_data=str(driver[0])
             )
         ])
     
+    markup = InlineKeyboardMarkup(keyboard)
+    report_cache['pdf_keyboard'] = (version, markup)
+    return markup
+
+def pdf_start(update, context):
     update.message.reply_text(
         "🧾 Select driver for PDF report:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=get_pdf_select_keyboard()
     )
 
 def pdf_button_callback(update, context):
     query = update.callback_query
     query.answer()
     
+    # CallbackQueryHandler 不支持用户过滤器，在此单独校验
+    if query.from_user.id not in ADMIN_IDS:
+        return
+    
     if query.data == "all":
-        query.edit_message_text("🔄 Generating reports for all drivers...")
-        generate_all_pdfs(query)
+        query.edit_message_text("🔄 Generating reports for all drivers, they will be sent when ready...")
+        pdf_executor.submit(generate_all_pdfs, query)
     else:
-        query.edit_message_text("🔄 Generating report...")
-        generate_single_pdf(query, int(query.data))
+        query.edit_message_text("🔄 Generating report, it will be sent when ready...")
+        pdf_executor.submit(generate_single_pdf, query, int(query.data))
+
+def build_driver_pdf(driver_id, name, data=None):
+    """在内存中为单个司机生成 PDF，返回读取位置已复位的缓冲区；
+    data 为预先批量读取的报告数据，省略时单独查询"""
+    if data is None:
+        data = fetch_driver_report_data([driver_id])[driver_id]
+    buf = io.BytesIO()
+    generate_driver_pdf(name, data, bot, buf)
+    buf.seek(0)
+    return buf
+
+def send_driver_pdf(chat_id, driver_id, name, buf):
+    """将内存中的 PDF 直接作为文档发送"""
+    wait_for_send_slot(chat_id)
+    bot.send_document(
+        chat_id=chat_id,
+        document=buf,
+        filename=f"driver_{driver_id}.pdf",
+        caption=f"Report for {name}"
+    )
+
+def build_named_driver_pdf(driver, report_data):
+    """为单个司机生成 PDF，返回 (司机ID, 显示名称, 缓冲区)"""
+    driver_id, first_name, username = driver
+    name = display_name(username, first_name)
+    return driver_id, name, build_driver_pdf(driver_id, name, report_data[driver_id])
+
+def iter_driver_pdfs(drivers, report_data):
+    """按司机顺序逐个产出 (司机ID, 显示名称, 缓冲区)，最多同时生成 PDF_WORKERS 份报告"""
+    with ThreadPoolExecutor(max_workers=PDF_WORKERS) as executor:
+        pending = deque()
+        for driver in drivers:
+            pending.append(executor.submit(build_named_driver_pdf, driver, report_data))
+            if len(pending) >= PDF_WORKERS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 def generate_all_pdfs(query):
     try:
-        temp_dir = tempfile.mkdtemp()
-        
-        with db_pool.getconn() as conn:
+        conn = get_db_connection()
+        try:
             with conn.cursor() as cur:
                 cur.execute("SELECT user_id, first_name, username FROM drivers")
                 drivers = cur.fetchall()
+        finally:
+            release_db_connection(conn)
         
-        for driver in drivers:
-            driver_id, first_name, username = driver
-            name = f"@{username}" if username else first_name
-            output_path = os.path.join(temp_dir, f"driver_{driver_id}.pdf")
-            generate_driver_pdf(driver_id, name, bot, output_path)
-            
-            with open(output_path, 'rb') as f:
-                bot.send_document(
-                    chat_id=query.message.chat_id,
-                    document=f,
-                    caption=f"Report for {name}"
-                )
+        # 所有司机的报告数据每张表只查询一次，避免每个司机单独查询
+        report_data = fetch_driver_report_data(driver[0] for driver in drivers)
+        
+        # 各司机的报告互不依赖，并行生成；每份报告生成后立即发送并释放，
+        # 发送当前报告的同时后续报告仍在生成，内存中最多保留 PDF_WORKERS 份
+        for driver_id, name, buf in iter_driver_pdfs(drivers, report_data):
+            send_driver_pdf(query.message.chat_id, driver_id, name, buf)
+        prune_photo_cache()
         
         query.edit_message_text("✅ All reports generated")
     except Exception as e:
-        logger.error(f"PDF generation error: {e}")
+        logger.error("PDF generation error: %s", e)
         query.edit_message_text(f"❌ Error: {str(e)}")
 
 def generate_single_pdf(query, driver_id):
     try:
-        with db_pool.getconn() as conn:
+        conn = get_db_connection()
+        try:
             with conn.cursor() as cur:
                 cur.execute(
                     "SELECT first_name, username FROM drivers WHERE user_id = %s",
                     (driver_id,)
                 )
                 driver = cur.fetchone()
+        finally:
+            release_db_connection(conn)
         
         if not driver:
             query.edit_message_text("❌ Driver not found")
             return
         
-        name = f"@{driver[1]}" if driver[1] else driver[0]
-        temp_dir = tempfile.mkdtemp()
-        output_path = os.path.join(temp_dir, f"driver_{driver_id}.pdf")
-        
-        generate_driver_pdf(driver_id, name, bot, output_path)
-        
-        with open(output_path, 'rb') as f:
-            bot.send_document(
-                chat_id=query.message.chat_id,
-                document=f,
-                caption=f"Report for {name}"
-            )
+        name = display_name(driver[1], driver[0])
+        buf = build_driver_pdf(driver_id, name)
+        send_driver_pdf(query.message.chat_id, driver_id, name, buf)
+        prune_photo_cache()
         
         query.edit_message_text("✅ Report generated")
     except Exception as e:
-        logger.error(f"PDF generation error: {e}")
+        logger.error("PDF generation error: %s", e)
         query.edit_message_text(f"❌ Error: {str(e)}")
 
 # === 充值功能 ===
 def topup_start(update, context):
     """开始充值流程"""
     try:
-        if update.effective_user.id not in ADMIN_IDS:
-            return
-        
         # 清理之前的状态
         context.user_data.clear()
         
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cur:
-                cur.execute("SELECT user_id, first_name, username FROM drivers")
-                drivers = cur.fetchall()
-        finally:
-            release_db_connection(conn)
-        
-        keyboard = [[f"{driver[1]} (ID: {driver[0]})"] for driver in drivers]
-        context.user_data['topup_drivers'] = {f"{driver[1]} (ID: {driver[0]})": driver[0] for driver in drivers}
+        keyboard, options = get_driver_select_keyboard()
+        context.user_data['topup_drivers'] = options
         
         update.message.reply_text(
             "👤 Select driver to top up:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+            reply_markup=keyboard
         )
         return TOPUP_USER
     except Exception as e:
-        logger.error(f"Error in topup_start: {str(e)}")
+        logger.error("Error in topup_start: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /topup command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -924,7 +1277,7 @@ def topup_user(update, context):
         )
         return TOPUP_AMOUNT
     except Exception as e:
-        logger.error(f"Error in topup_user: {str(e)}")
+        logger.error("Error in topup_user: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /topup command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -933,9 +1286,8 @@ def topup_user(update, context):
 
 def topup_amount(update, context):
     try:
-        try:
-            amount = float(update.message.text)
-        except ValueError:
+        amount = parse_amount(update.message.text)
+        if amount is None:
             update.message.reply_text(
                 "❌ Please enter a valid number.",
                 reply_markup=ReplyKeyboardRemove()
@@ -944,25 +1296,28 @@ def topup_amount(update, context):
         
         driver_id = context.user_data.get('selected_driver')
         admin_id = update.effective_user.id
-        date = datetime.datetime.now(pytz.timezone("Asia/Kuala_Lumpur")).strftime("%Y-%m-%d")
+        date = get_current_date()
         
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cur:
-                # 更新余额
-                cur.execute(
-                    "UPDATE drivers SET balance = balance + %s WHERE user_id = %s",
-                    (amount, driver_id)
-                )
-                
-                # 记录充值
-                cur.execute(
-                    "INSERT INTO topups (user_id, amount, date, admin_id) VALUES (%s, %s, %s, %s)",
-                    (driver_id, amount, date, admin_id)
-                )
-                conn.commit()
-        finally:
-            release_db_connection(conn)
+        # 与该司机自己的报销操作共用同一把锁，保证余额变更按顺序进行
+        with get_user_lock(driver_id):
+            conn = get_db_connection()
+            try:
+                with conn.cursor() as cur:
+                    # 更新余额
+                    cur.execute(
+                        "UPDATE drivers SET balance = balance + %s WHERE user_id = %s",
+                        (amount, driver_id)
+                    )
+                    
+                    # 记录充值
+                    cur.execute(
+                        "INSERT INTO topups (user_id, amount, date, admin_id) VALUES (%s, %s, %s, %s)",
+                        (driver_id, amount, date, admin_id)
+                    )
+                    conn.commit()
+                    invalidate_report_cache()
+            finally:
+                release_db_connection(conn)
         
         update.message.reply_text(
             f"✅ Topped up RM{amount:.2f}",
@@ -973,7 +1328,7 @@ def topup_amount(update, context):
         context.user_data.clear()
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Error in topup_amount: {str(e)}")
+        logger.error("Error in topup_amount: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /topup command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -981,20 +1336,21 @@ def topup_amount(update, context):
         return ConversationHandler.END
 
 # === 报销功能 ===
+CLAIM_TYPE_KEYBOARD = ReplyKeyboardMarkup([["Toll", "Petrol"], ["Parking", "Other"]], one_time_keyboard=True)
+
 def claim_start(update, context):
     """开始报销流程"""
     try:
         # 清理之前的状态
         context.user_data.clear()
         
-        keyboard = [["Toll", "Petrol"], ["Parking", "Other"]]
         update.message.reply_text(
             "🚗 Select claim type:",
-            reply_markup=ReplyKeyboardMarkup(keyboard, one_time_keyboard=True)
+            reply_markup=CLAIM_TYPE_KEYBOARD
         )
         return CLAIM_TYPE
     except Exception as e:
-        logger.error(f"Error in claim_start: {str(e)}")
+        logger.error("Error in claim_start: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /claim command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -1019,7 +1375,7 @@ def claim_type(update, context):
         )
         return CLAIM_AMOUNT
     except Exception as e:
-        logger.error(f"Error in claim_type: {str(e)}")
+        logger.error("Error in claim_type: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /claim command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -1035,7 +1391,7 @@ def claim_other_type(update, context):
         )
         return CLAIM_AMOUNT
     except Exception as e:
-        logger.error(f"Error in claim_other_type: {str(e)}")
+        logger.error("Error in claim_other_type: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /claim command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -1044,9 +1400,8 @@ def claim_other_type(update, context):
 
 def claim_amount(update, context):
     try:
-        try:
-            amount = float(update.message.text)
-        except ValueError:
+        amount = parse_amount(update.message.text)
+        if amount is None:
             update.message.reply_text(
                 "❌ Please enter a valid number.",
                 reply_markup=ReplyKeyboardRemove()
@@ -1057,7 +1412,7 @@ def claim_amount(update, context):
         update.message.reply_text("📎 Please send a photo of the receipt:")
         return CLAIM_PROOF
     except Exception as e:
-        logger.error(f"Error in claim_amount: {str(e)}")
+        logger.error("Error in claim_amount: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /claim command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -1068,27 +1423,36 @@ def claim_proof(update, context):
     try:
         user = update.effective_user
         photo_file = update.message.photo[-1].file_id
-        date = datetime.datetime.now(pytz.timezone("Asia/Kuala_Lumpur")).strftime("%Y-%m-%d")
+        date = get_current_date()
         
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cur:
-                # 记录报销
-                cur.execute(
-                    "INSERT INTO claims (user_id, type, amount, date, photo_file_id) "
-                    "VALUES (%s, %s, %s, %s, %s)",
-                    (user.id, context.user_data['claim_type'], 
-                     context.user_data['claim_amount'], date, photo_file)
-                )
-                
-                # 扣除余额
-                cur.execute(
-                    "UPDATE drivers SET balance = balance - %s WHERE user_id = %s",
-                    (context.user_data['claim_amount'], user.id)
-                )
-                conn.commit()
-        finally:
-            release_db_connection(conn)
+        # 同一用户的操作串行执行，避免并发请求交错读写
+        with get_user_lock(user.id):
+            conn = get_db_connection()
+            try:
+                with conn.cursor() as cur:
+                    ensure_driver(cur, user)
+                    
+                    # 记录报销
+                    cur.execute(
+                        "INSERT INTO claims (user_id, type, amount, date, photo_file_id) "
+                        "VALUES (%s, %s, %s, %s, %s)",
+                        (user.id, context.user_data['claim_type'], 
+                         context.user_data['claim_amount'], date, photo_file)
+                    )
+                    
+                    # 扣除余额
+                    cur.execute(
+                        "UPDATE drivers SET balance = balance - %s WHERE user_id = %s",
+                        (context.user_data['claim_amount'], user.id)
+                    )
+                    conn.commit()
+                    invalidate_report_cache()
+                    remember_driver(user)
+            finally:
+                release_db_connection(conn)
+        
+        # 提交时即在后台下载并压缩收据照片，之后生成 PDF 直接使用缓存
+        photo_executor.submit(download_telegram_photo, photo_file, bot)
         
         update.message.reply_text(
             f"✅ Claim submitted for {context.user_data['claim_type']}: "
@@ -1100,7 +1464,7 @@ def claim_proof(update, context):
         context.user_data.clear()
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Error in claim_proof: {str(e)}")
+        logger.error("Error in claim_proof: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /claim command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -1117,7 +1481,7 @@ def cancel(update, context):
             reply_markup=ReplyKeyboardRemove()
         )
     except Exception as e:
-        logger.error(f"Error in cancel: {str(e)}")
+        logger.error("Error in cancel: %s", e)
         update.message.reply_text(
             "❌ An error occurred while cancelling.",
             reply_markup=ReplyKeyboardRemove()
@@ -1134,31 +1498,47 @@ def error_handler(update, context):
             )
     except:
         logger.error("Failed to send error message to user")
-    
-    tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-    tb_string = ''.join(tb_list)
-    logger.error(f"Full traceback:\n{tb_string}")
 
 # === Webhook ===
+def process_update_in_background(update):
+    """在后台线程中处理更新"""
+    try:
+        dispatcher.process_update(update)
+    except Exception as e:
+        logger.error("Error processing update %s: %s", update.update_id, e)
+
+def submit_update(update):
+    """按聊天 ID 将更新分配到固定的执行器"""
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    update_executors[key % len(update_executors)].submit(process_update_in_background, update)
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
+    # 设置了密钥时，只接受 Telegram 携带正确密钥的请求，在解析请求体之前拒绝；
+    # 按字节比较，请求头含非 ASCII 字符时不会抛出 TypeError
+    secret_header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+        secret_header.encode('latin-1'), WEBHOOK_SECRET.encode()
+    ):
+        return "forbidden", 403
+    
     try:
-        if not dispatcher:
+        if dispatcher is None:
             init_bot()
-        update = Update.de_json(request.get_json(force=True), bot)
-        dispatcher.process_update(update)
+        update = Update.de_json(orjson.loads(request.get_data(cache=False)), bot)
+        submit_update(update)
         return "ok"
+    except HTTPException:
+        # 请求体过大等情况交给 Flask 返回对应的状态码（如 413）
+        raise
     except Exception as e:
-        logger.error(f"Error processing webhook: {e}")
+        logger.error("Error processing webhook: %s", e)
         return "error", 500
-    finally:
-        # 确保每个请求结束后释放所有空闲连接
-        if db_pool:
-            try:
-                while db_pool.putconn(db_pool.getconn(), close=True):
-                    pass
-            except psycopg2.pool.PoolError:
-                pass
 
 # === 健康检查端点 ===
 @app.route("/health")
@@ -1173,7 +1553,7 @@ if __name__ == "__main__":
     # 本地开发时使用
     init_bot()  # 初始化 bot
     logger.info("Starting bot in development mode...")
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    app.run(host="0.0.0.0", port=PORT)
 else:
     # Gunicorn 生产环境使用
     logger.info("Starting bot in production mode...")
@@ -1190,7 +1570,7 @@ else:
             # 构建完整的 webhook URL
             webhook_url = f"https://{render_external_url}/webhook"
             
-            logger.info(f"Attempting to set webhook URL to: {webhook_url}")
+            logger.info("Attempting to set webhook URL to: %s", webhook_url)
             
             # 先删除现有的 webhook
             bot.delete_webhook()
@@ -1198,7 +1578,8 @@ else:
             # 设置新的 webhook，使用最基本的配置
             success = bot.set_webhook(
                 url=webhook_url,
-                max_connections=100
+                max_connections=100,
+                secret_token=WEBHOOK_SECRET
             )
             
             if success:
@@ -1212,8 +1593,7 @@ else:
             raise ValueError("No valid external URL environment variable found")
             
     except Exception as e:
-        logger.error(f"Error during webhook setup: {str(e)}")
-        logger.error(f"Full error: {traceback.format_exc()}")
+        logger.exception("Error during webhook setup: %s", e)
         raise
 
 # 添加一个路由来显示当前 webhook 状态
@@ -1236,7 +1616,7 @@ def webhook_status():
 # === 时间处理工具 ===
 def get_current_time():
     """获取当前时间（马来西亚时区）"""
-    return datetime.datetime.now(pytz.timezone("Asia/Kuala_Lumpur"))
+    return datetime.datetime.now(LOCAL_TZ)
 
 def get_current_date():
     """获取当前日期（马来西亚时区）"""
@@ -1254,22 +1634,35 @@ def format_datetime(dt):
 def init_bot():
     """初始化 Telegram Bot 和 Dispatcher"""
     global dispatcher
-    dispatcher = Dispatcher(bot, None, use_context=True)
+    # gthread 下多个首次请求可能同时到达，加锁确保只创建一个 Dispatcher
+    with dispatcher_lock:
+        if dispatcher is not None:
+            return
+        dispatcher = build_dispatcher()
+    
+    logger.info("Bot handlers initialized successfully")
+
+def build_dispatcher():
+    """创建 Dispatcher 并注册所有处理器，全部注册完成后才返回"""
+    dp = Dispatcher(bot, None, use_context=True)
     
     # 注册命令处理器
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("clockin", clockin))
-    dispatcher.add_handler(CommandHandler("clockout", clockout))
-    dispatcher.add_handler(CommandHandler("offday", offday))
-    dispatcher.add_handler(CommandHandler("balance", balance))
-    dispatcher.add_handler(CommandHandler("check", check))
-    dispatcher.add_handler(CommandHandler("viewclaims", viewclaims))
-    dispatcher.add_handler(CommandHandler("PDF", pdf_start))
-    dispatcher.add_handler(CallbackQueryHandler(pdf_button_callback, pattern=r'^all|\d+$'))
+    dp.add_handler(CommandHandler("start", start))
+    dp.add_handler(CommandHandler("clockin", clockin))
+    dp.add_handler(CommandHandler("clockout", clockout))
+    dp.add_handler(CommandHandler("offday", offday))
+    # 管理员命令只对 ADMIN_IDS 中的用户生效，其他用户的更新在过滤阶段即被丢弃
+    admin_filter = Filters.user(user_id=ADMIN_IDS)
+    
+    dp.add_handler(CommandHandler("balance", balance, filters=admin_filter))
+    dp.add_handler(CommandHandler("check", check, filters=admin_filter))
+    dp.add_handler(CommandHandler("viewclaims", viewclaims, filters=admin_filter))
+    dp.add_handler(CommandHandler("PDF", pdf_start, filters=admin_filter))
+    dp.add_handler(CallbackQueryHandler(pdf_button_callback, pattern=r'^all|\d+$'))
 
     # 注册对话处理器
-    dispatcher.add_handler(ConversationHandler(
-        entry_points=[CommandHandler("salary", salary_start)],
+    dp.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("salary", salary_start, filters=admin_filter)],
         states={
             SALARY_SELECT_DRIVER: [MessageHandler(Filters.text & ~Filters.command, salary_select_driver)],
             SALARY_ENTER_AMOUNT: [MessageHandler(Filters.text & ~Filters.command, salary_enter_amount)],
@@ -1277,8 +1670,8 @@ def init_bot():
         fallbacks=[CommandHandler("cancel", cancel)],
     ))
 
-    dispatcher.add_handler(ConversationHandler(
-        entry_points=[CommandHandler("topup", topup_start)],
+    dp.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("topup", topup_start, filters=admin_filter)],
         states={
             TOPUP_USER: [MessageHandler(Filters.text & ~Filters.command, topup_user)],
             TOPUP_AMOUNT: [MessageHandler(Filters.text & ~Filters.command, topup_amount)],
@@ -1286,7 +1679,7 @@ def init_bot():
         fallbacks=[CommandHandler("cancel", cancel)],
     ))
 
-    dispatcher.add_handler(ConversationHandler(
+    dp.add_handler(ConversationHandler(
         entry_points=[CommandHandler("claim", claim_start)],
         states={
             CLAIM_TYPE: [MessageHandler(Filters.text & ~Filters.command, claim_type)],
@@ -1298,8 +1691,8 @@ def init_bot():
     ))
 
     # 更新PAID命令处理器
-    dispatcher.add_handler(ConversationHandler(
-        entry_points=[CommandHandler("paid", paid_start)],
+    dp.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("paid", paid_start, filters=admin_filter)],
         states={
             PAID_SELECT_DRIVER: [MessageHandler(Filters.text & ~Filters.command, paid_select_driver)],
             PAID_START_DATE: [MessageHandler(Filters.text & ~Filters.command, paid_start_date)],
@@ -1309,9 +1702,9 @@ def init_bot():
     ))
 
     # 注册错误处理器
-    dispatcher.add_error_handler(error_handler)
+    dp.add_error_handler(error_handler)
     
-    logger.info("Bot handlers initialized successfully")
+    return dp
 
 def calculate_work_summary(user_id):
     """计算员工工作统计"""
@@ -1345,7 +1738,7 @@ def calculate_work_summary(user_id):
             total_salary = total_hours * hourly_rate
             
             return {
-                'name': f"@{username}" if username else first_name,
+                'name': display_name(username, first_name),
                 'total_days': total_days,
                 'total_hours': total_hours,
                 'hourly_rate': hourly_rate,
@@ -1402,7 +1795,7 @@ def calculate_work_summary_with_date_range(user_id, start_date, end_date):
             total_salary = total_hours * hourly_rate
             
             return {
-                'name': f"@{username}" if username else first_name,
+                'name': display_name(username, first_name),
                 'total_days': total_days,
                 'total_hours': total_hours,
                 'hourly_rate': hourly_rate,
@@ -1411,7 +1804,7 @@ def calculate_work_summary_with_date_range(user_id, start_date, end_date):
                 'end_date': end_date
             }
     except Exception as e:
-        logger.error(f"Error in calculate_work_summary_with_date_range: {str(e)}")
+        logger.error("Error in calculate_work_summary_with_date_range: %s", e)
         return None
     finally:
         release_db_connection(conn)
@@ -1426,9 +1819,6 @@ def validate_date(date_str):
 def paid_start(update, context):
     """开始PAID命令处理"""
     try:
-        if update.effective_user.id not in ADMIN_IDS:
-            return
-        
         # 清理之前可能存在的状态
         context.user_data.clear()
         
@@ -1462,7 +1852,7 @@ def paid_start(update, context):
         )
         return PAID_SELECT_DRIVER
     except Exception as e:
-        logger.error(f"Error in paid_start: {str(e)}")
+        logger.error("Error in paid_start: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /paid command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -1489,7 +1879,7 @@ def paid_select_driver(update, context):
         )
         return PAID_START_DATE
     except Exception as e:
-        logger.error(f"Error in paid_select_driver: {str(e)}")
+        logger.error("Error in paid_select_driver: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /paid command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -1511,7 +1901,7 @@ def paid_start_date(update, context):
         update.message.reply_text("📅 Enter end date (DD/MM/YYYY):")
         return PAID_END_DATE
     except Exception as e:
-        logger.error(f"Error in paid_start_date: {str(e)}")
+        logger.error("Error in paid_start_date: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /paid command again.",
             reply_markup=ReplyKeyboardRemove()
@@ -1562,7 +1952,7 @@ def paid_end_date(update, context):
         context.user_data.clear()
         return ConversationHandler.END
     except Exception as e:
-        logger.error(f"Error in paid_end_date: {str(e)}")
+        logger.error("Error in paid_end_date: %s", e)
         update.message.reply_text(
             "❌ An error occurred. Please try /paid command again.",
             reply_markup=ReplyKeyboardRemove()
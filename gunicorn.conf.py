@@ -0,0 +1,14 @@
+import os
+
+# === Gunicorn 配置 ===
+# 启动命令: gunicorn clock_bot:app
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# 对话状态（context.user_data）保存在进程内存中，只能使用单个 worker 进程，
+# 通过多线程来并发处理 Telegram 的 webhook 请求
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+timeout = 120
@@ -33,7 +33,7 @@ def init_database():
             user_id BIGINT PRIMARY KEY,
             username TEXT,
             first_name TEXT,
-            balance FLOAT DEFAULT 0.0,
+            balance NUMERIC(12, 2) DEFAULT 0,
             monthly_salary FLOAT DEFAULT 3500.0,
             total_hours FLOAT DEFAULT 0.0,
             created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
@@ -61,7 +61,7 @@ def init_database():
         CREATE TABLE IF NOT EXISTS topups (
             id SERIAL PRIMARY KEY,
             user_id BIGINT REFERENCES drivers(user_id),
-            amount FLOAT NOT NULL,
+            amount NUMERIC(12, 2) NOT NULL,
             date DATE NOT NULL,
             admin_id BIGINT,
             created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
@@ -75,7 +75,7 @@ def init_database():
             id SERIAL PRIMARY KEY,
             user_id BIGINT REFERENCES drivers(user_id),
             type TEXT NOT NULL,
-            amount FLOAT NOT NULL,
+            amount NUMERIC(12, 2) NOT NULL,
             date DATE NOT NULL,
             photo_file_id TEXT,
             status TEXT DEFAULT 'pending',
@@ -84,6 +84,17 @@ def init_database():
         """)
         logger.info("创建 claims 表成功")
         
+        # 旧版本用 FLOAT 存储金额，迁移为精确到分的 NUMERIC
+        cur.execute("""
+        SELECT table_name, column_name
+        FROM information_schema.columns
+        WHERE (table_name, column_name) IN (('drivers', 'balance'), ('topups', 'amount'), ('claims', 'amount'))
+        AND data_type = 'double precision'
+        """)
+        for table, column in cur.fetchall():
+            cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE NUMERIC(12, 2)")
+            logger.info("迁移 %s.%s 为 NUMERIC(12, 2) 成功", table, column)
+        
         # 5. 创建索引
         # 为常用查询创建索引以提高性能
         cur.execute("""
@@ -99,7 +110,7 @@ def init_database():
         logger.info("数据库初始化完成！")
         
     except Exception as e:
-        logger.error(f"数据库初始化失败: {str(e)}")
+        logger.error("数据库初始化失败: %s", e)
         raise
 
 def main():
@@ -107,7 +118,7 @@ def main():
     try:
         init_database()
     except Exception as e:
-        logger.error(f"程序执行失败: {str(e)}")
+        logger.error("程序执行失败: %s", e)
         exit(1)
 
 if __name__ == "__main__":